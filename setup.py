@@ -32,6 +32,10 @@ setup(
     install_requires=['numpy>=1.11.3', 'scipy>=0.18.1'],
     extras_require={
         'symbolic': ['sympy>=1.0'],
+        'symengine': ['sympy>=1.0', 'symengine>=0.4'],
+        'symjit': ['sympy>=1.0', 'symjit'],
+        'numba': ['sympy>=1.0', 'numba'],
+        'ccode': ['sympy>=1.0', 'cffi>=1.0'],
         'doc': ['sphinx>=1.6.3', 'sympy>=1.0'],
         'examples': ['matplotlib>=2.0', 'sympy>=1.0'],
     },
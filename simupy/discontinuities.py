@@ -1,7 +1,8 @@
 import sympy as sp
 import numpy as np
+from sympy.physics.mechanics.functions import find_dynamicsymbols
 from simupy.systems.symbolic import (DynamicalSystem, MemorylessSystem,
-                                     dynamicsymbols, find_dynamicsymbols)
+                                     dynamicsymbols)
 from simupy.systems import SwitchedSystem as SwitchedSystemBase
 from simupy.array import r_
 
@@ -84,6 +85,27 @@ class SwitchedSystem(SwitchedSystemBase, DiscontinuousSystem):
         self.condition_idx = None
         self.validate(True)
 
+    # these are generated from a single state or output equation, so they are
+    # not available when the corresponding equations switch
+    _switched_state_attributes = (
+        'state_jacobian_equation', 'input_jacobian_equation',
+        'state_jacobian_equation_function', 'input_jacobian_equation_function',
+        'state_jacobian_sparsity', 'state_and_jacobian_function',
+    )
+    _switched_output_attributes = (
+        'output_jacobian_equation', 'output_jacobian_equation_function',
+        'output_equation_function_batched',
+    )
+
+    def __getattr__(self, name):
+        if ((name in self._switched_state_attributes and
+                self.__dict__.get('_state_equations') is not None) or
+                (name in self._switched_output_attributes and
+                 self.__dict__.get('_output_equations') is not None)):
+            raise AttributeError(
+                "'{}' is not available for switched equations".format(name))
+        return super().__getattr__(name)
+
     def prepare_to_integrate(self):
         # TODO: refactor the setters so I can call an update instead
         self.event_variable_equation = self.event_variable_equation
@@ -180,19 +202,18 @@ class SwitchedSystem(SwitchedSystemBase, DiscontinuousSystem):
         self._state_update_equation = state_update_equation
         if self.dim_state:
             assert find_dynamicsymbols(state_update_equation) <= \
-                set(self.state) | set(self.input)
+                self._state_input_set
             self.state_update_equation_function = self.code_generator(
-                    ([dynamicsymbols._t] + 
-                     sp.flatten(self.state) + sp.flatten(self.input)),
-                    self._state_update_equation.subs(self.constants_values),
+                    self._full_args,
+                    self._substitute_constants(self._state_update_equation),
                     **self.code_generator_args
             )
         else:
             assert find_dynamicsymbols(state_update_equation) <= \
-                set(self.input)
+                self._input_set
             self.state_update_equation_function = self.code_generator(
-                    [dynamicsymbols._t] + sp.flatten(self.input),
-                    self._state_update_equation.subs(self.constants_values),
+                    self._output_args_input,
+                    self._substitute_constants(self._state_update_equation),
                     **self.code_generator_args
             )
 
@@ -207,18 +228,18 @@ class SwitchedSystem(SwitchedSystemBase, DiscontinuousSystem):
         self._event_variable_equation = event_variable_equation
         if self.dim_state:
             assert find_dynamicsymbols(event_variable_equation) <= \
-                set(self.state)
+                self._state_set
             self.event_variable_equation_function = self.code_generator(
-                [dynamicsymbols._t] + sp.flatten(self.state),
-                self._event_variable_equation.subs(self.constants_values),
+                self._output_args_with_state,
+                self._substitute_constants(self._event_variable_equation),
                 **self.code_generator_args
             )
         else:
             assert find_dynamicsymbols(event_variable_equation) <= \
-                set(self.input)
+                self._input_set
             self.event_variable_equation_function = self.code_generator(
-                [dynamicsymbols._t] + sp.flatten(self.input),
-                self._event_variable_equation.subs(self.constants_values),
+                self._output_args_input,
+                self._substitute_constants(self._event_variable_equation),
                 **self.code_generator_args
             )
 
@@ -240,7 +261,7 @@ class SwitchedSystem(SwitchedSystemBase, DiscontinuousSystem):
                 self.state_equations_functions.size
         self._event_bounds_expressions = event_bounds_exp
         self.event_bounds = np.array(
-            [sp.N(bound, subs=self.constants_values)
+            [sp.N(self._substitute_constants(sp.sympify(bound)))
              for bound in event_bounds_exp],
             dtype=np.float_
         )
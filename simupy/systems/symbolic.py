@@ -1,17 +1,159 @@
+from collections import OrderedDict
+from fractions import Fraction
+from types import MappingProxyType
+import numpy as np
 import sympy as sp
+from scipy.sparse import csr_matrix
+from sympy.core.function import AppliedUndef
 from sympy.physics.mechanics import dynamicsymbols
-from sympy.physics.mechanics.functions import find_dynamicsymbols
-from simupy.utils.symbolic import (lambdify_with_vector_args, grad, 
-    DEFAULT_LAMBDIFY_MODULES)
+from simupy.utils.symbolic import (lambdify_with_vector_args,
+    lambdify_broadcast_args, forward_jacobian, DEFAULT_LAMBDIFY_MODULES)
+from simupy.utils.symbolic_backends import (symengine,
+    symengine_llvm_generator)
 from simupy.array import Array, empty_array
 
 from simupy.systems import DynamicalSystem as DynamicalSystemBase
 
-DEFAULT_CODE_GENERATOR = lambdify_with_vector_args
+if symengine is not None:
+    DEFAULT_CODE_GENERATOR = symengine_llvm_generator
+else:
+    DEFAULT_CODE_GENERATOR = lambdify_with_vector_args
 DEFAULT_CODE_GENERATOR_ARGS = {
     'modules': DEFAULT_LAMBDIFY_MODULES
 }
 
+CODE_GENERATOR_CACHE_SIZE = 256
+_code_generator_cache = OrderedDict()
+
+
+def _compile(code_generator, args, expr, code_generator_args):
+    """
+    Call the code generator, re-using the callable previously generated for a
+    structurally identical argument list, expression, and code generator
+    configuration.
+    """
+    # srepr does not capture the numerical implementation of implemented
+    # functions, so expressions using them are always generated
+    if any(hasattr(func, '_imp_') for func in expr.atoms(AppliedUndef)):
+        return code_generator(args, expr, **code_generator_args)
+
+    key = (
+        tuple(sp.srepr(arg) for arg in args),
+        sp.srepr(expr),
+        code_generator,
+        repr(sorted(code_generator_args.items())),
+    )
+    if key in _code_generator_cache:
+        _code_generator_cache.move_to_end(key)
+        return _code_generator_cache[key]
+
+    function = code_generator(args, expr, **code_generator_args)
+    _code_generator_cache[key] = function
+    if len(_code_generator_cache) > CODE_GENERATOR_CACHE_SIZE:
+        _code_generator_cache.popitem(last=False)
+    return function
+
+
+def _constant_function(expr):
+    """
+    Create a function returning the numerical value of an expression with no
+    free symbols, following the calling convention of the code generators, so
+    no code needs to be generated.
+    """
+    outputs = expr if isinstance(expr, sp.Tuple) else (expr,)
+    values = []
+    for output in outputs:
+        if hasattr(output, 'tolist'):
+            value = np.array(output.tolist(), dtype=np.float_).reshape(
+                output.shape)
+        else:
+            value = np.array(float(output))
+        # the same array is returned on every call
+        value.setflags(write=False)
+        values.append(value)
+
+    if isinstance(expr, sp.Tuple):
+        values = tuple(values)
+        return lambda *args: values
+    value = values[0]
+    return lambda *args: value
+
+
+def _canonical_constant(value):
+    """
+    Replace a sympy Float by the Rational with a small denominator that is
+    equal as a float, if there is one, so constants given as floats or exact
+    numbers substitute identically. Other values are returned unchanged.
+    """
+    if isinstance(value, sp.Float):
+        fraction = Fraction(float(value)).limit_denominator(10**6)
+        if float(fraction) == float(value):
+            return sp.Rational(fraction.numerator, fraction.denominator)
+    return value
+
+
+def _nonzero_entries(matrix):
+    """
+    Find the structurally non-zero entries of a matrix expression.
+
+    Returns
+    -------
+    rows, cols : ndarray of ints
+        The indices of the non-zero entries, in row-major order.
+    values : list of sympy Expressions
+        The non-zero entries.
+    """
+    rows, cols, values = [], [], []
+    for row in range(matrix.rows):
+        for col in range(matrix.cols):
+            if matrix[row, col] != 0:
+                rows.append(row)
+                cols.append(col)
+                values.append(matrix[row, col])
+    return np.array(rows, dtype=int), np.array(cols, dtype=int), values
+
+
+def _collect_symbols_and_dynamics(expr):
+    """
+    Collect the symbols and the dynamicsymbols of an expression in a single
+    traversal, equivalent to ``expr.atoms(sp.Symbol)`` and
+    ``find_dynamicsymbols(expr)``.
+    """
+    t_set = {dynamicsymbols._t}
+    syms = set()
+    dsyms = set()
+    for node in sp.preorder_traversal(expr):
+        if isinstance(node, sp.Symbol):
+            syms.add(node)
+        elif (isinstance(node, (AppliedUndef, sp.Derivative)) and
+                node.free_symbols == t_set):
+            dsyms.add(node)
+    return syms, dsyms
+
+
+def _expanded_jacobian(expr, basis):
+    """
+    Compute the jacobian of an expression with ``forward_jacobian``, so shared
+    subexpressions are only differentiated once, then expand the
+    subexpressions for the code generator.
+    """
+    replacements, jacobian = forward_jacobian(expr, basis)
+    substitutions = {}
+    for sym, rhs in replacements:
+        substitutions[sym] = rhs.xreplace(substitutions)
+    return jacobian.xreplace(substitutions)
+
+
+def _joint_jacobian(expr, state_vars, input_vars):
+    """
+    Compute the state and input jacobians of an expression with a single
+    forward pass over the state and input together, so the partials they
+    share are only derived once.
+    """
+    state_vars, input_vars = list(state_vars), list(input_vars)
+    jacobian = _expanded_jacobian(expr, state_vars + input_vars)
+    return jacobian[:, :len(state_vars)], jacobian[:, len(state_vars):]
+
 
 class DynamicalSystem(DynamicalSystemBase):
     def __init__(self, state_equation=None, state=None, input_=None,
@@ -37,7 +179,9 @@ class DynamicalSystem(DynamicalSystemBase):
         output_equation : array_like of sympy Expressions
             Vector valued expression for the output of the system.
         constants_values : dict
-            Dictionary of constants substitutions.
+            Dictionary of constants substitutions, keyed by sympy Symbols.
+            Stored as a read-only mapping; assign a new dictionary to change
+            the constants.
         dt : float
             Sampling rate of system. Use 0 for continuous time systems.
         initial_condition : array_like of numerical values, optional
@@ -49,12 +193,19 @@ class DynamicalSystem(DynamicalSystemBase):
             Dictionary of keyword args to pass to the code generator.
 
 
-        By default, the code generator uses a wrapper for ``sympy.lambdify``.
+        By default, the code generator uses SymEngine's LLVM backend if
+        SymEngine is installed, and a wrapper for ``sympy.lambdify`` otherwise.
         You can change it by passing the system initialization arguments
         ``code_generator`` (the function) and additional keyword arguments to
         the generator in a dictionary ``code_generator_args``. You can change
         the defaults for future systems by changing the module values. See the
-        readme or docs for an example.
+        readme or docs for an example. The state and input jacobians are only
+        computed when first accessed, and their non-zero entries are generated
+        together as a single column ``sympy.Matrix``. The
+        ``state_and_jacobian_function`` is generated from a ``sympy.Tuple`` of
+        the state equation and these entries, so the code generator must
+        return a callable producing a sequence for ``Tuple`` expressions to
+        use it.
 
         """
         self.constants_values = constants_values
@@ -75,6 +226,103 @@ class DynamicalSystem(DynamicalSystemBase):
 
         self.validate()
 
+    @property
+    def constants_values(self):
+        return self._constants_values
+
+    @constants_values.setter
+    def constants_values(self, constants_values):
+        # constants are substituted with xreplace, which only matches exactly
+        if not all(isinstance(constant, sp.Symbol)
+                   for constant in constants_values):
+            raise ValueError("constants_values keys must be sympy Symbols")
+        self._constants_values = MappingProxyType({
+            constant: sp.sympify(value)
+            for constant, value in constants_values.items()
+        })
+        # floats are converted to exact numbers once, so equal constants are
+        # recognized as common subexpressions by the code generators
+        self._constants_canonical = MappingProxyType({
+            constant: _canonical_constant(value)
+            for constant, value in self._constants_values.items()
+        })
+        self._dirty = True
+        self._invalidate('_state_jacobian_entries', '_input_jacobian_entries',
+                         'state_jacobian_equation_function',
+                         'input_jacobian_equation_function',
+                         'state_jacobian_sparsity',
+                         'state_and_jacobian_function',
+                         'output_jacobian_equation_function',
+                         'output_equation_function_batched')
+        if hasattr(self, '_state_equation'):
+            self._update_state_equation_subs()
+        if hasattr(self, '_output_equation'):
+            self._update_output_equation_subs()
+
+    def _substitute_constants(self, expr):
+        if expr == empty_array():
+            return expr
+        return expr.xreplace(self._constants_canonical)
+
+    def _update_state_equation_subs(self):
+        self._state_equation_subs = self._substitute_constants(
+            self._state_equation)
+
+    def _update_output_equation_subs(self):
+        self._output_equation_subs = self._substitute_constants(
+            self._output_equation)
+
+    # attributes that are only built when first accessed, mapped to the
+    # method that builds them; see __getattr__
+    _lazy_attributes = {
+        'state_jacobian_equation': '_build_state_jacobian_equations',
+        'input_jacobian_equation': '_build_state_jacobian_equations',
+        '_state_jacobian_entries': '_build_state_jacobian_entries',
+        '_input_jacobian_entries': '_build_state_jacobian_entries',
+        'state_jacobian_equation_function': '_build_state_jacobian_functions',
+        'input_jacobian_equation_function': '_build_state_jacobian_functions',
+        'state_jacobian_sparsity': '_build_state_jacobian_sparsity',
+        'state_and_jacobian_function': '_build_state_and_jacobian_function',
+        'output_jacobian_equation': '_build_output_jacobian_equation',
+        'output_jacobian_equation_function': '_build_output_jacobian_function',
+        'output_equation_function_batched':
+            '_build_output_equation_function_batched',
+    }
+
+    def __getattr__(self, name):
+        # only called when regular attribute lookup fails, so a lazy attribute
+        # is built once and then found in the instance __dict__
+        builder = type(self)._lazy_attributes.get(name)
+        if builder is not None:
+            # an AttributeError from the builder would otherwise look like the
+            # attribute does not exist
+            try:
+                getattr(self, builder)()
+            except Exception as error:
+                raise RuntimeError(
+                    "failed to build '{}'".format(name)) from error
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, name))
+
+    def _invalidate(self, *names):
+        for name in names:
+            self.__dict__.pop(name, None)
+
+    def _invalidate_state_jacobians(self):
+        self._invalidate('state_jacobian_equation', 'input_jacobian_equation',
+                         '_state_jacobian_entries', '_input_jacobian_entries',
+                         'state_jacobian_equation_function',
+                         'input_jacobian_equation_function',
+                         'state_jacobian_sparsity',
+                         'state_and_jacobian_function')
+
+    def _invalidate_output_attributes(self):
+        self._invalidate('output_jacobian_equation',
+                         'output_jacobian_equation_function',
+                         'output_equation_function_batched')
+
     @property
     def state(self):
         return self._state
@@ -87,6 +335,13 @@ class DynamicalSystem(DynamicalSystemBase):
             state = Array([state])
         self.dim_state = len(state)
         self._state = state
+        self._state_flat = sp.flatten(state)
+        self._state_set = frozenset(self._state_flat)
+        self._update_args()
+        self._dirty = True
+        self._equilibrium_cache = {}
+        self._invalidate_state_jacobians()
+        self._invalidate_output_attributes()
 
     @property
     def input(self):
@@ -100,6 +355,21 @@ class DynamicalSystem(DynamicalSystemBase):
             input_ = Array([input_])
         self.dim_input = len(input_)
         self._inputs = input_
+        self._input_flat = sp.flatten(input_)
+        self._input_set = frozenset(self._input_flat)
+        self._update_args()
+        self._dirty = True
+        self._invalidate_state_jacobians()
+        self._invalidate_output_attributes()
+
+    def _update_args(self):
+        state_flat = getattr(self, '_state_flat', [])
+        input_flat = getattr(self, '_input_flat', [])
+        self._full_args = [dynamicsymbols._t] + state_flat + input_flat
+        self._output_args_with_state = [dynamicsymbols._t] + state_flat
+        self._output_args_input = [dynamicsymbols._t] + input_flat
+        self._state_input_set = (getattr(self, '_state_set', frozenset())
+                                 | getattr(self, '_input_set', frozenset()))
 
     @property
     def state_equation(self):
@@ -107,26 +377,31 @@ class DynamicalSystem(DynamicalSystemBase):
 
     @state_equation.setter
     def state_equation(self, state_equation):
+        if (not getattr(self, '_dirty', True) and
+                (state_equation is self._state_equation or
+                 sp.srepr(state_equation) == sp.srepr(self._state_equation))):
+            # the function may have been re-assigned, e.g. by SwitchedSystem
+            self.state_equation_function = self._state_equation_fn
+            return
+
         if state_equation is None:  # or other checks?
             state_equation = empty_array()
         else:
             assert len(state_equation) == len(self.state)
-            assert find_dynamicsymbols(state_equation) <= (
-                    set(self.state) | set(self.input)
-                )
-            assert state_equation.atoms(sp.Symbol) <= (
+            syms, dsyms = _collect_symbols_and_dynamics(state_equation)
+            assert dsyms <= self._state_input_set
+            assert syms <= (
                     set(self.constants_values.keys())
                     | set([dynamicsymbols._t])
                 )
 
         self._state_equation = state_equation
-        self.update_state_equation_function()
+        self._dirty = True
+        self._equilibrium_cache = {}
+        self._invalidate_state_jacobians()
+        self._update_state_equation_subs()
 
-        self.state_jacobian_equation = grad(self.state_equation, self.state)
-        self.update_state_jacobian_function()
-
-        self.input_jacobian_equation = grad(self.state_equation, self.input)
-        self.update_input_jacobian_function()
+        self.update_state_equation_function()
 
     @property
     def output_equation(self):
@@ -142,70 +417,206 @@ class DynamicalSystem(DynamicalSystemBase):
             if output_equation is None:
                 output_equation = self.state
 
-            assert output_equation.atoms(sp.Symbol) <= (
+            syms, dsyms = _collect_symbols_and_dynamics(output_equation)
+            assert syms <= (
                     set(self.constants_values.keys())
                     | set([dynamicsymbols._t])
                    )
 
             if self.dim_state:
-                assert find_dynamicsymbols(output_equation) <= set(self.state)
+                assert dsyms <= self._state_set
             else:
-                assert find_dynamicsymbols(output_equation) <= set(self.input)
+                assert dsyms <= self._input_set
 
         self.dim_output = len(output_equation)
 
         self._output_equation = output_equation
+        self._invalidate_output_attributes()
+        self._update_output_equation_subs()
         self.update_output_equation_function()
 
-    def update_state_equation_function(self):
+    def _generate_function(self, args, expr):
+        if not expr.free_symbols:
+            return _constant_function(expr)
+        return _compile(self.code_generator, args, expr,
+                        self.code_generator_args)
+
+    def _build_state_equation_function(self):
+        self._state_equation_fn = self._generate_function(
+            self._full_args,
+            self._state_equation_subs
+        )
+        self._dirty = False
+        self.state_equation_function = self._state_equation_fn
+
+    def _build_state_jacobian_equations(self):
         if not self.dim_state or self.state_equation == empty_array():
+            self.state_jacobian_equation = sp.Matrix()
+            self.input_jacobian_equation = sp.Matrix()
             return
-        self.state_equation_function = self.code_generator(
-            [dynamicsymbols._t] + sp.flatten(self.state) +
-            sp.flatten(self.input),
-            self.state_equation.subs(self.constants_values),
-            **self.code_generator_args
+
+        self.state_jacobian_equation, self.input_jacobian_equation = \
+            _joint_jacobian(self.state_equation, self._state_flat,
+                            self._input_flat)
+
+    def _build_state_jacobian_entries(self):
+        """
+        Substitute the constants into both jacobians and find their
+        structurally non-zero entries once, for the jacobian functions, the
+        fused state and jacobian function, and the sparsity pattern.
+        """
+        self._state_jacobian_entries = _nonzero_entries(
+            self._substitute_constants(self.state_jacobian_equation))
+        self._input_jacobian_entries = _nonzero_entries(
+            self._substitute_constants(self.input_jacobian_equation))
+
+    def _build_state_jacobian_functions(self):
+        """
+        Generate a single function evaluating the structurally non-zero
+        entries of both jacobians, so common subexpressions are shared between
+        them, and expose each jacobian through a wrapper that scatters its
+        entries into an array.
+        """
+        if not self.dim_state or self.state_equation == empty_array():
+            return
+        state_rows, state_cols, state_values = self._state_jacobian_entries
+        input_rows, input_cols, input_values = self._input_jacobian_entries
+        values_function = self._generate_function(
+            self._full_args,
+            sp.Matrix(state_values + input_values)
         )
 
-    def update_state_jacobian_function(self):
+        num_state_values = len(state_values)
+        state_shape = self.state_jacobian_equation.shape
+        state_index = (state_rows, state_cols)
+        input_shape = self.input_jacobian_equation.shape
+        input_index = (input_rows, input_cols)
+
+        def state_jacobian_equation_function(*args):
+            jacobian = np.zeros(state_shape)
+            jacobian[state_index] = \
+                np.ravel(values_function(*args))[:num_state_values]
+            return jacobian
+
+        def input_jacobian_equation_function(*args):
+            jacobian = np.zeros(input_shape)
+            jacobian[input_index] = \
+                np.ravel(values_function(*args))[num_state_values:]
+            return jacobian
+
+        self.state_jacobian_equation_function = \
+            state_jacobian_equation_function
+        self.input_jacobian_equation_function = \
+            input_jacobian_equation_function
+
+    def _build_state_and_jacobian_function(self):
+        """
+        Generate a single function evaluating both the state equation and the
+        state jacobian, so common subexpressions are shared between them, for
+        solvers that need both at the same point.
+        """
         if not self.dim_state or self.state_equation == empty_array():
             return
-        self.state_jacobian_equation_function = self.code_generator(
-            [dynamicsymbols._t] + sp.flatten(self.state) +
-            sp.flatten(self.input),
-            self.state_jacobian_equation.subs(self.constants_values),
-            **self.code_generator_args
+        rows, cols, values = self._state_jacobian_entries
+        fused_function = self._generate_function(
+            self._full_args,
+            sp.Tuple(self._state_equation_subs, sp.Matrix(values))
         )
+        shape = self.state_jacobian_equation.shape
 
-    def update_input_jacobian_function(self):
-        # TODO: state-less systems should have an input/output jacobian
+        def state_and_jacobian_function(*args):
+            state_derivative, jacobian_values = fused_function(*args)
+            jacobian = np.zeros(shape)
+            jacobian[rows, cols] = np.ravel(jacobian_values)
+            return state_derivative, jacobian
+        self.state_and_jacobian_function = state_and_jacobian_function
+
+    def _build_state_jacobian_sparsity(self):
         if not self.dim_state or self.state_equation == empty_array():
             return
-        self.input_jacobian_equation_function = self.code_generator(
-            [dynamicsymbols._t] + sp.flatten(self.state) +
-            sp.flatten(self.input),
-            self.input_jacobian_equation.subs(self.constants_values),
-            **self.code_generator_args
+        rows, cols, _ = self._state_jacobian_entries
+        self.state_jacobian_sparsity = csr_matrix(
+            (np.ones(len(rows)), (rows, cols)),
+            shape=(self.dim_state, self.dim_state)
         )
 
+    def _build_output_jacobian_equation(self):
+        if not self.dim_output:
+            self.output_jacobian_equation = sp.Matrix()
+        elif self.dim_state:
+            self.output_jacobian_equation = _expanded_jacobian(
+                self.output_equation, self._state_flat)
+        else:
+            self.output_jacobian_equation = _expanded_jacobian(
+                self.output_equation, self._input_flat)
+
+    def _build_output_jacobian_function(self):
+        if not self.dim_output or self.output_equation == empty_array():
+            return
+        if self.dim_state:
+            output_args = self._output_args_with_state
+        else:
+            output_args = self._output_args_input
+        self.output_jacobian_equation_function = self._generate_function(
+            output_args,
+            self._substitute_constants(self.output_jacobian_equation)
+        )
+
+    def update_state_equation_function(self):
+        if not self.dim_state or self.state_equation == empty_array():
+            return
+        if self._dirty:
+            self._build_state_equation_function()
+
+    def update_state_jacobian_function(self):
+        # re-generated on next access
+        self._invalidate('state_jacobian_equation_function')
+
+    def update_input_jacobian_function(self):
+        # TODO: state-less systems should have an input/output jacobian
+        self._invalidate('input_jacobian_equation_function')
+
     def update_output_equation_function(self):
         if not self.dim_output or self.output_equation == empty_array():
             return
         if self.dim_state:
-            self.output_equation_function = self.code_generator(
-                [dynamicsymbols._t] + sp.flatten(self.state),
-                self.output_equation.subs(self.constants_values),
-                **self.code_generator_args
-            )
+            output_args = self._output_args_with_state
         else:
-            self.output_equation_function = self.code_generator(
-                [dynamicsymbols._t] + sp.flatten(self.input),
-                self.output_equation.subs(self.constants_values),
-                **self.code_generator_args
-            )
+            output_args = self._output_args_input
+        self.output_equation_function = self._generate_function(
+            output_args,
+            self._output_equation_subs
+        )
+        self._invalidate('output_jacobian_equation_function',
+                         'output_equation_function_batched')
+
+    def _build_output_equation_function_batched(self):
+        if not self.dim_output or self.output_equation == empty_array():
+            return
+        if self.dim_state:
+            output_args = self._output_args_with_state
+        else:
+            output_args = self._output_args_input
+        # batched evaluation is for post-processing, so always use lambdify
+        self.output_equation_function_batched = _compile(
+            lambdify_broadcast_args,
+            output_args,
+            self._output_equation_subs,
+            {
+                key: self.code_generator_args[key]
+                for key in ('modules', 'cse')
+                if key in self.code_generator_args
+            }
+        )
 
     def prepare_to_integrate(self):
         self.update_output_equation_function()
+        # code_generator or code_generator_args may have changed since the
+        # functions were generated
+        self._dirty = True
+        self._invalidate('state_jacobian_equation_function',
+                         'input_jacobian_equation_function',
+                         'state_and_jacobian_function')
         self.update_state_equation_function()
 
     def copy(self):
@@ -215,14 +626,30 @@ class DynamicalSystem(DynamicalSystemBase):
             input_=self.input,
             output_equation=self.output_equation,
             constants_values=self.constants_values,
-            dt=self.dt
+            dt=self.dt,
+            code_generator=self.code_generator,
+            code_generator_args=self.code_generator_args
         )
         copy.output_equation_function = self.output_equation_function
         copy.state_equation_function = self.state_equation_function
+        # only share the jacobian functions that have already been built
+        for name in ('state_jacobian_equation_function',
+                     'input_jacobian_equation_function',
+                     'state_and_jacobian_function',
+                     'output_jacobian_equation_function'):
+            if name in self.__dict__:
+                setattr(copy, name, self.__dict__[name])
         return copy
 
     def equilibrium_points(self, input_=None):
-        return sp.solve(self.state_equation, self.state, dict=True)
+        # solving is deterministic but expensive, so re-use the solutions
+        # until the state or state equation changes
+        key = (sp.srepr(self.state_equation), sp.srepr(self.state),
+               sp.srepr(input_))
+        if key not in self._equilibrium_cache:
+            self._equilibrium_cache[key] = sp.solve(
+                self.state_equation, self.state, dict=True)
+        return [dict(solution) for solution in self._equilibrium_cache[key]]
 
 
 class MemorylessSystem(DynamicalSystem):
@@ -261,3 +688,7 @@ class MemorylessSystem(DynamicalSystem):
                              "state_equation")
         self.dim_state = len(state)
         self._state = state
+        self._state_flat = []
+        self._state_set = frozenset()
+        self._update_args()
+        self._equilibrium_cache = {}
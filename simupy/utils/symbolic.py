@@ -1,3 +1,5 @@
+import ast
+import inspect
 import numpy as np
 import sympy as sp
 from sympy.utilities.lambdify import implemented_function
@@ -6,6 +8,14 @@ from simupy.array import r_, Array
 
 DEFAULT_LAMBDIFY_MODULES = ({'ImmutableMatrix': np.matrix, "atan2": np.arctan2}, "numpy", {"Mod": np.mod, "atan2": np.arctan2})
 
+# skip generating the docstring of lambdified functions, which prints the
+# whole expression, on versions of sympy that support it
+_LAMBDIFY_KWARGS = (
+    {'docstring_limit': 0}
+    if 'docstring_limit' in inspect.signature(sp.lambdify).parameters
+    else {}
+)
+
 
 def process_vector_args(args):
     """
@@ -37,7 +47,26 @@ def process_vector_args(args):
     return tuple(new_args)
 
 
-def lambdify_with_vector_args(args, expr, modules=DEFAULT_LAMBDIFY_MODULES):
+def _vector_arg_size(arg):
+    """
+    The number of components of a vector argument, following the rules of
+    ``process_vector_args``, or None if the argument is atomic.
+    """
+    if hasattr(arg, 'shape') and len(arg.shape) > 0:
+        shape = arg.shape
+        if (min(shape) != 1 and len(shape) == 2) or len(shape) > 2:
+            raise AttributeError("Arguments should only contain vectors")
+        return max(shape)
+    elif isinstance(arg, (list, tuple)):
+        if any(isinstance(element, (list, tuple)) for element in arg):
+            raise AttributeError("Arguments should not be nested " +
+                                 "lists/tuples")
+        return len(arg)
+    return None
+
+
+def lambdify_with_vector_args(args, expr, modules=DEFAULT_LAMBDIFY_MODULES,
+                              cse=True):
     """
     A wrapper around sympy's lambdify where process_vector_args is used so
     generated callable can take arguments as either vector or individual
@@ -48,9 +77,13 @@ def lambdify_with_vector_args(args, expr, modules=DEFAULT_LAMBDIFY_MODULES):
     args : list-like of sympy symbols
         Input arguments to the expression to call
     expr : sympy expression
-        Expression to turn into a callable for numeric evaluation
+        Expression to turn into a callable for numeric evaluation. If a sympy
+        ``Tuple``, the callable returns a tuple with an array for each element.
     modules : list
         See lambdify documentation; passed directly as modules keyword.
+    cse : bool
+        If true, common subexpressions are evaluated once as local variables
+        of the generated function, see ``lambdify_cse``.
 
     """
     new_args = process_vector_args(args)
@@ -58,15 +91,250 @@ def lambdify_with_vector_args(args, expr, modules=DEFAULT_LAMBDIFY_MODULES):
     if sp.__version__ < '1.1' and hasattr(expr, '__len__'):
         expr = sp.Matrix(expr)
 
-    f = sp.lambdify(new_args, expr, modules=modules)
+    if cse:
+        f = lambdify_cse(new_args, cse_expression(expr), modules=modules)
+    else:
+        f = sp.lambdify(new_args, expr, modules=modules, **_LAMBDIFY_KWARGS)
 
     def lambda_function_with_vector_args(*func_args):
         new_func_args = process_vector_args(func_args)
+        if isinstance(expr, sp.Tuple):
+            return tuple(np.array(val) for val in f(*new_func_args))
         return np.array(f(*new_func_args))
     lambda_function_with_vector_args.__doc__ = f.__doc__
     return lambda_function_with_vector_args
 
 
+def lambdify_array_args(args, expr, modules=DEFAULT_LAMBDIFY_MODULES,
+                        cse=True):
+    """
+    A wrapper around sympy's lambdify where vector arguments are passed to the
+    generated function as 1D arrays, which the generated code indexes
+    directly instead of unravelling the arguments on each call. A function is
+    generated for each way the callable is called, e.g., a time, a state
+    vector, and an input vector, grouping the components of ``args`` in order.
+
+    Parameters
+    ----------
+    args : list-like of sympy symbols
+        Input arguments to the expression to call
+    expr : sympy expression
+        Expression to turn into a callable for numeric evaluation. If a sympy
+        ``Tuple``, the callable returns a tuple with an array for each element.
+    modules : list
+        See lambdify documentation; passed directly as modules keyword.
+    cse : bool
+        If true, common subexpressions are evaluated once as local variables
+        of the generated function, see ``lambdify_cse``.
+    """
+    new_args = process_vector_args(args)
+    if cse:
+        cse_expr = cse_expression(expr)
+    functions = {}
+
+    def generate_function(grouping):
+        num_components = sum(1 if size is None else size for size in grouping)
+        if num_components != len(new_args):
+            raise TypeError(
+                "expected {} argument components, got {}".format(
+                    len(new_args), num_components))
+        grouped_args = []
+        replacements = {}
+        idx = 0
+        for arg_idx, size in enumerate(grouping):
+            if size is None:
+                grouped_args.append(new_args[idx])
+                idx += 1
+                continue
+            vector = sp.DeferredVector('_vector_arg{}'.format(arg_idx))
+            for element_idx in range(size):
+                replacements[new_args[idx]] = vector[element_idx]
+                idx += 1
+            grouped_args.append(vector)
+
+        if cse:
+            replacements_list, reduced = cse_expr
+            return lambdify_cse(
+                grouped_args,
+                ([(sym, rhs.xreplace(replacements))
+                  for sym, rhs in replacements_list],
+                 reduced.xreplace(replacements)),
+                modules=modules
+            )
+        return sp.lambdify(grouped_args, expr.xreplace(replacements),
+                           modules=modules, **_LAMBDIFY_KWARGS)
+
+    is_tuple = isinstance(expr, sp.Tuple)
+
+    def lambda_function_with_array_args(*func_args):
+        grouping = tuple(_vector_arg_size(func_arg) for func_arg in func_args)
+        if grouping not in functions:
+            functions[grouping] = generate_function(grouping)
+        result = functions[grouping](*(
+            func_arg if size is None else np.ravel(func_arg)
+            for func_arg, size in zip(func_args, grouping)
+        ))
+        if is_tuple:
+            return tuple(np.array(val) for val in result)
+        return np.array(result)
+    return lambda_function_with_array_args
+
+
+def lambdify_broadcast_args(args, expr, modules=DEFAULT_LAMBDIFY_MODULES,
+                            cse=True):
+    """
+    A wrapper around sympy's lambdify where the generated callable evaluates
+    the expression at many points at once, for example along a trajectory.
+    The generated callable takes the time as an array of any shape, followed
+    by vector arguments whose last axis indexes their components; all of these
+    are broadcast together. Constant components of the expression are
+    broadcast to the same shape, so the result has the broadcast shape
+    followed by the expression's shape.
+
+    Parameters
+    ----------
+    args : list-like of sympy symbols
+        Input arguments to the expression to call
+    expr : sympy expression
+        Expression to turn into a callable for numeric evaluation
+    modules : list
+        See lambdify documentation; passed directly as modules keyword.
+    cse : bool
+        If true, common subexpressions are evaluated once as local variables
+        of the generated function, see ``lambdify_cse``.
+    """
+    new_args = process_vector_args(args)
+
+    if hasattr(expr, 'tolist'):
+        shape = tuple(expr.shape)
+        flat_expr = sp.Tuple(*sp.flatten(expr.tolist()))
+    else:
+        shape = tuple()
+        flat_expr = sp.Tuple(expr)
+
+    if cse:
+        f = lambdify_cse(new_args, cse_expression(flat_expr), modules=modules)
+    else:
+        f = sp.lambdify(new_args, flat_expr, modules=modules,
+                        **_LAMBDIFY_KWARGS)
+
+    def lambda_function_with_broadcast_args(t, *func_args):
+        components = [np.asarray(t)]
+        for func_arg in func_args:
+            components.extend(np.moveaxis(np.atleast_1d(func_arg), -1, 0))
+        components = np.broadcast_arrays(*components)
+        points_shape = components[0].shape
+        values = [
+            np.broadcast_to(value, points_shape)
+            for value in f(*components)
+        ]
+        return np.stack(values, axis=-1).reshape(points_shape + shape)
+    return lambda_function_with_broadcast_args
+
+
+def cse_expression(expr):
+    """
+    Perform common subexpression elimination on an array_like expression, or a
+    sympy ``Tuple`` of them, keeping the structure of the expression.
+
+    Parameters
+    ----------
+    expr : sympy expression
+        The expression to eliminate common subexpressions from.
+
+    Returns
+    -------
+    replacements : list of (symbol, expression) pairs
+        The common subexpressions, in evaluation order.
+    reduced : sympy expression
+        The expression in terms of the replacement symbols.
+    """
+    outputs = expr if isinstance(expr, sp.Tuple) else (expr,)
+    flat_exprs = []
+    for output in outputs:
+        if hasattr(output, 'tolist'):
+            flat_exprs.extend(sp.flatten(output.tolist()))
+        else:
+            flat_exprs.append(output)
+
+    # lambdify dummifies every argument if any is a Dummy, which breaks
+    # dynamicsymbol arguments, so use regular symbols with unused names
+    symbols = sp.numbered_symbols('_cse', exclude=set().union(
+        *[flat_expr.free_symbols for flat_expr in flat_exprs]))
+    replacements, flat_reduced = sp.cse(flat_exprs, symbols=symbols,
+                                        order='none')
+
+    reduced = []
+    idx = 0
+    for output in outputs:
+        if isinstance(output, sp.MatrixBase):
+            size = output.rows*output.cols
+            reduced.append(sp.ImmutableMatrix(
+                output.rows, output.cols, flat_reduced[idx:idx+size]))
+        elif hasattr(output, 'tolist'):
+            size = len(output)
+            reduced.append(Array(flat_reduced[idx:idx+size], output.shape))
+        else:
+            size = 1
+            reduced.append(flat_reduced[idx])
+        idx += size
+
+    if isinstance(expr, sp.Tuple):
+        return replacements, sp.Tuple(*reduced)
+    return replacements, reduced[0]
+
+
+def lambdify_cse(args, expr, modules=DEFAULT_LAMBDIFY_MODULES):
+    """
+    A wrapper around sympy's lambdify for an expression given as common
+    subexpression replacements and a reduced expression, as returned by
+    ``cse_expression``. The generated function assigns each replacement to a
+    local variable before evaluating the reduced expression.
+
+    Parameters
+    ----------
+    args : list-like of sympy symbols
+        Input arguments to the expression to call
+    expr : tuple of replacements and reduced sympy expression
+        Expression to turn into a callable for numeric evaluation.
+    modules : list
+        See lambdify documentation; passed directly as modules keyword.
+    """
+    replacements, reduced = expr
+    if not replacements:
+        return sp.lambdify(args, reduced, modules=modules,
+                           **_LAMBDIFY_KWARGS)
+
+    # let lambdify print the replacements and reduced expression as a single
+    # return value, with the replacement symbols as trailing arguments
+    cse_symbols = [sym for sym, rhs in replacements]
+    f = sp.lambdify(
+        list(args) + cse_symbols,
+        sp.Tuple(*[rhs for sym, rhs in replacements], reduced),
+        modules=modules,
+        **_LAMBDIFY_KWARGS
+    )
+
+    # then rewrite the function so the trailing arguments are assigned from
+    # the returned replacement expressions, in order
+    module = ast.parse(inspect.getsource(f))
+    function_def = module.body[0]
+    return_value = function_def.body[-1].value
+    cse_args = function_def.args.args[-len(cse_symbols):]
+    del function_def.args.args[-len(cse_symbols):]
+    function_def.body[-1:] = [
+        ast.Assign(targets=[ast.Name(id=arg.arg, ctx=ast.Store())],
+                   value=value)
+        for arg, value in zip(cse_args, return_value.elts[:-1])
+    ] + [ast.Return(value=return_value.elts[-1])]
+    ast.fix_missing_locations(module)
+
+    function_locals = {}
+    exec(compile(module, '<lambdify_cse>', 'exec'), f.__globals__,
+         function_locals)
+    return function_locals[function_def.name]
+
+
 def grad(f, basis, for_numerical=True):
     """
     Compute the symbolic gradient of a vector-valued function with respect to a
@@ -98,6 +366,74 @@ def grad(f, basis, for_numerical=True):
     ])
 
 
+def forward_jacobian(f, basis, for_numerical=True):
+    """
+    Compute the symbolic Jacobian of a vector-valued function with respect to a
+    basis by forward accumulation over its common subexpressions, so each
+    shared subexpression is differentiated only once.
+
+    Parameters
+    ----------
+    f : 1D array_like of sympy Expressions
+        The vector-valued function to compute the Jacobian of.
+    basis : 1D array_like of sympy symbols
+        The basis symbols to compute the Jacobian with respect to.
+    for_numerical : bool, optional
+        If true, entries are zeroed where the function depends on the sign of
+        the basis symbol, matching ``grad``.
+
+    Returns
+    -------
+    replacements : list of (symbol, expression) pairs
+        The subexpressions referenced by the Jacobian, in evaluation order.
+    jacobian : 2D array_like of sympy Expressions
+        The symbolic Jacobian in terms of the replacement symbols.
+    """
+    exprs = sp.flatten(f)
+    basis = sp.flatten(basis)
+    symbols = sp.numbered_symbols(cls=sp.Dummy)
+    cse_replacements, reduced = sp.cse(exprs, symbols=symbols)
+
+    partials = {}
+
+    def accumulate(expr):
+        derivatives = {}
+        for idx, var in enumerate(basis):
+            if expr.has(var):
+                derivatives[idx] = sp.diff(expr, var)
+        for sym in expr.free_symbols & partials.keys():
+            outer = sp.diff(expr, sym)
+            for idx, inner in partials[sym].items():
+                derivatives[idx] = derivatives.get(idx, 0) + outer*inner
+        return {idx: val for idx, val in derivatives.items() if val != 0}
+
+    replacements = []
+    for sym, rhs in cse_replacements:
+        replacements.append((sym, rhs))
+        derivatives = accumulate(rhs)
+        for idx, val in derivatives.items():
+            if not val.is_Atom:
+                derivatives[idx] = next(symbols)
+                replacements.append((derivatives[idx], val))
+        partials[sym] = derivatives
+
+    jacobian = sp.Matrix.zeros(len(exprs), len(basis))
+    for row, expr in enumerate(reduced):
+        for col, val in accumulate(expr).items():
+            if not for_numerical or not exprs[row].has(sp.sign(basis[col])):
+                jacobian[row, col] = val
+
+    # only keep the replacements the jacobian actually depends on
+    needed = set(jacobian.free_symbols)
+    used_replacements = []
+    for sym, rhs in reversed(replacements):
+        if sym in needed:
+            used_replacements.append((sym, rhs))
+            needed |= rhs.free_symbols
+
+    return used_replacements[::-1], jacobian
+
+
 def augment_input(system, input_=[], update_outputs=True):
     """
     Augment input, useful to construct control-affine systems.
@@ -0,0 +1,415 @@
+import hashlib
+import importlib.machinery
+import importlib.util
+import os
+import platform
+import shutil
+import tempfile
+import numpy as np
+import sympy as sp
+from sympy.core.function import AppliedUndef
+from sympy.printing.ccode import C99CodePrinter
+from sympy.printing.pycode import NumPyPrinter
+from simupy.utils.symbolic import (process_vector_args,
+    lambdify_with_vector_args, DEFAULT_LAMBDIFY_MODULES)
+
+try:
+    import symengine
+except ImportError:
+    symengine = None
+
+try:
+    import symjit
+except ImportError:
+    symjit = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import cffi
+except ImportError:
+    cffi = None
+
+CCODE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'simupy')
+CCODE_COMPILE_ARGS = ['-O3', '-march=native', '-ffast-math']
+
+
+def flatten_outputs(expr):
+    """
+    A helper function to flatten a (possibly ``Tuple`` of) array_like
+    expression into a single list of scalar expressions so it can be passed to
+    code generators that only produce flat outputs.
+
+    Returns
+    -------
+    flat_exprs : list of sympy Expressions
+        The scalar components of every output, in row-major order.
+    shapes : list of tuples
+        The shape of each output.
+    """
+    outputs = expr if isinstance(expr, sp.Tuple) else (expr,)
+    flat_exprs = []
+    shapes = []
+    for output in outputs:
+        if hasattr(output, 'tolist'):
+            shapes.append(tuple(output.shape))
+            flat_exprs.extend(sp.flatten(output.tolist()))
+        else:
+            shapes.append(tuple())
+            flat_exprs.append(sp.sympify(output))
+    return flat_exprs, shapes
+
+
+def unflatten_outputs(values, shapes, is_tuple):
+    """
+    The inverse of ``flatten_outputs`` for the numerical values of the flat
+    outputs.
+    """
+    outputs = []
+    idx = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        outputs.append(np.reshape(values[idx:idx+size], shape))
+        idx += size
+    if is_tuple:
+        return tuple(outputs)
+    return outputs[0]
+
+
+def dummify_args(args, expr):
+    """
+    A helper function to replace the (possibly vector) arguments of an
+    expression with dummy symbols, since compiled backends generally only take
+    symbols as arguments.
+
+    Returns
+    -------
+    dummies : list of sympy Dummy symbols
+        The dummy symbol for each component of the arguments.
+    flat_exprs : list of sympy Expressions
+        The flattened outputs in terms of the dummy symbols, see
+        ``flatten_outputs``.
+    shapes : list of tuples
+        The shape of each output.
+    """
+    new_args = process_vector_args(args)
+    dummies = [sp.Dummy() for arg in new_args]
+    replacements = dict(zip(new_args, dummies))
+    flat_exprs, shapes = flatten_outputs(expr)
+    flat_exprs = [
+        flat_expr.xreplace(replacements) for flat_expr in flat_exprs
+    ]
+    return dummies, flat_exprs, shapes
+
+
+def has_undefined_functions(flat_exprs):
+    """
+    Check if any expression uses a function application that is not an
+    argument, such as an implemented function, which compiled backends cannot
+    evaluate.
+    """
+    return any(flat_expr.atoms(AppliedUndef) for flat_expr in flat_exprs)
+
+
+def symengine_llvm_generator(args, expr, modules=DEFAULT_LAMBDIFY_MODULES,
+                             cse=True):
+    """
+    A code generator using SymEngine's LLVM backend, with the same calling
+    convention as ``lambdify_with_vector_args``. If SymEngine is not installed
+    or cannot compile the expression (for example, if it uses implemented
+    functions), ``lambdify_with_vector_args`` is used instead.
+
+    Parameters
+    ----------
+    args : list-like of sympy symbols
+        Input arguments to the expression to call
+    expr : sympy expression
+        Expression to turn into a callable for numeric evaluation. If a sympy
+        ``Tuple``, the callable returns a tuple with an array for each element.
+    modules : list
+        Passed to ``lambdify_with_vector_args`` if SymEngine is not used.
+    cse : bool
+        Whether to perform common subexpression elimination.
+    """
+    dummies, flat_exprs, shapes = dummify_args(args, expr)
+
+    if (symengine is None or not flat_exprs or
+            has_undefined_functions(flat_exprs)):
+        return lambdify_with_vector_args(args, expr, modules=modules, cse=cse)
+
+    # SymEngine raises a variety of exceptions for expressions it cannot
+    # convert or compile, so fall back on any of them
+    try:
+        f = symengine.Lambdify(dummies, flat_exprs, backend='llvm', cse=cse,
+                               real=True)
+    except Exception:
+        return lambdify_with_vector_args(args, expr, modules=modules, cse=cse)
+
+    is_tuple = isinstance(expr, sp.Tuple)
+
+    def symengine_function_with_vector_args(*func_args):
+        new_func_args = np.array(process_vector_args(func_args),
+                                 dtype=np.float_)
+        return unflatten_outputs(f(new_func_args), shapes, is_tuple)
+    return symengine_function_with_vector_args
+
+
+def symjit_generator(args, expr, modules=DEFAULT_LAMBDIFY_MODULES, cse=True):
+    """
+    A code generator using symjit to compile directly to machine code, with
+    the same calling convention as ``lambdify_with_vector_args``. This is
+    best suited to systems with small state dimension, where the per-call
+    overhead of NumPy dominates. Expressions symjit cannot compile (for
+    example, if they use implemented functions) use
+    ``lambdify_with_vector_args`` instead.
+
+    Parameters
+    ----------
+    args : list-like of sympy symbols
+        Input arguments to the expression to call
+    expr : sympy expression
+        Expression to turn into a callable for numeric evaluation. If a sympy
+        ``Tuple``, the callable returns a tuple with an array for each element.
+    modules : list
+        Passed to ``lambdify_with_vector_args`` if symjit is not used.
+    cse : bool
+        Whether to perform common subexpression elimination.
+    """
+    if symjit is None:
+        raise ImportError("symjit_generator requires symjit")
+
+    dummies, flat_exprs, shapes = dummify_args(args, expr)
+
+    if not flat_exprs or has_undefined_functions(flat_exprs):
+        return lambdify_with_vector_args(args, expr, modules=modules, cse=cse)
+
+    f = symjit.compile_func(dummies, flat_exprs, cse=cse)
+
+    is_tuple = isinstance(expr, sp.Tuple)
+
+    def symjit_function_with_vector_args(*func_args):
+        new_func_args = process_vector_args(func_args)
+        return unflatten_outputs(np.asarray(f(*new_func_args)), shapes,
+                                 is_tuple)
+    return symjit_function_with_vector_args
+
+
+def numba_generator(args, expr, modules=DEFAULT_LAMBDIFY_MODULES, cse=True):
+    """
+    A code generator using Numba to compile the expression to machine code,
+    with the same calling convention as ``lambdify_with_vector_args``. The
+    function is compiled when it is generated, so the first evaluation does
+    not include the compilation time.
+    Expressions Numba cannot compile (for example, if they use implemented
+    functions) use ``lambdify_with_vector_args`` instead.
+
+    Parameters
+    ----------
+    args : list-like of sympy symbols
+        Input arguments to the expression to call
+    expr : sympy expression
+        Expression to turn into a callable for numeric evaluation. If a sympy
+        ``Tuple``, the callable returns a tuple with an array for each element.
+    modules : list
+        Passed to ``lambdify_with_vector_args`` if Numba is not used.
+    cse : bool
+        Whether to perform common subexpression elimination.
+    """
+    if numba is None:
+        raise ImportError("numba_generator requires numba")
+
+    # every component of the arguments is read from a single input array
+    new_args = process_vector_args(args)
+    replacements = {
+        arg: sp.Symbol('_in[{}]'.format(idx))
+        for idx, arg in enumerate(new_args)
+    }
+    flat_exprs, shapes = flatten_outputs(expr)
+    flat_exprs = [
+        flat_expr.xreplace(replacements) for flat_expr in flat_exprs
+    ]
+
+    if not flat_exprs or has_undefined_functions(flat_exprs):
+        return lambdify_with_vector_args(args, expr, modules=modules, cse=cse)
+
+    if cse:
+        cse_replacements, flat_exprs = sp.cse(
+            flat_exprs, symbols=sp.numbered_symbols('_cse'), order='none')
+    else:
+        cse_replacements = []
+
+    printer = NumPyPrinter()
+    lines = ['def _numba_function(_in):']
+    for sym, rhs in cse_replacements:
+        lines.append('    {} = {}'.format(sym, printer.doprint(rhs)))
+    lines.append('    _out = numpy.empty({})'.format(len(flat_exprs)))
+    for idx, flat_expr in enumerate(flat_exprs):
+        lines.append(
+            '    _out[{}] = {}'.format(idx, printer.doprint(flat_expr)))
+    lines.append('    return _out')
+
+    # unsupported functions are printed as comments, which fail to parse, and
+    # functions Numba cannot type fail to compile, so fall back on either
+    namespace = {'numpy': np}
+    try:
+        exec('\n'.join(lines), namespace)
+        f = numba.njit((numba.float64[:],), fastmath=True)(
+            namespace['_numba_function'])
+    except Exception:
+        return lambdify_with_vector_args(args, expr, modules=modules, cse=cse)
+
+    num_args = len(new_args)
+    is_tuple = isinstance(expr, sp.Tuple)
+
+    def numba_function_with_vector_args(*func_args):
+        new_func_args = np.array(process_vector_args(func_args),
+                                 dtype=np.float_)
+        # the compiled function does not check bounds
+        if new_func_args.shape != (num_args,):
+            raise TypeError(
+                "expected {} argument components, got {}".format(
+                    num_args, new_func_args.size))
+        return unflatten_outputs(f(new_func_args), shapes, is_tuple)
+    return numba_function_with_vector_args
+
+
+def _load_extension_module(module_name, path):
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _FloorModC99CodePrinter(C99CodePrinter):
+    def _print_Mod(self, expr):
+        # fmod takes the sign of the dividend, but sympy's Mod takes the sign
+        # of the divisor
+        num, den = (self._print(arg) for arg in expr.args)
+        return '(({0}) - ({1})*floor(({0})/({1})))'.format(num, den)
+
+
+def ccode_generator(args, expr, modules=DEFAULT_LAMBDIFY_MODULES, cse=True,
+                    cache_dir=None):
+    """
+    A code generator emitting C code for the expression, compiled into an
+    extension module with cffi, with the same calling convention as
+    ``lambdify_with_vector_args``. Compiled modules are cached by a hash of
+    the generated source, so generating the same expression again, even from
+    another process, does not re-compile it. This is best suited to systems
+    with large state dimension. Expressions that cannot be compiled (for
+    example, if they use implemented functions) use
+    ``lambdify_with_vector_args`` instead.
+
+    Parameters
+    ----------
+    args : list-like of sympy symbols
+        Input arguments to the expression to call
+    expr : sympy expression
+        Expression to turn into a callable for numeric evaluation. If a sympy
+        ``Tuple``, the callable returns a tuple with an array for each element.
+    modules : list
+        Passed to ``lambdify_with_vector_args`` if the C code is not used.
+    cse : bool
+        Whether to perform common subexpression elimination.
+    cache_dir : str, optional
+        Directory of the compiled modules. Defaults to ``CCODE_CACHE_DIR``.
+    """
+    if cffi is None:
+        raise ImportError("ccode_generator requires cffi")
+
+    # every component of the arguments is read from a single input array
+    new_args = process_vector_args(args)
+    replacements = {
+        arg: sp.Symbol('_in[{}]'.format(idx))
+        for idx, arg in enumerate(new_args)
+    }
+    flat_exprs, shapes = flatten_outputs(expr)
+    flat_exprs = [
+        flat_expr.xreplace(replacements) for flat_expr in flat_exprs
+    ]
+
+    if not flat_exprs or has_undefined_functions(flat_exprs):
+        return lambdify_with_vector_args(args, expr, modules=modules, cse=cse)
+
+    if cse:
+        cse_replacements, flat_exprs = sp.cse(
+            flat_exprs, symbols=sp.numbered_symbols('_cse'), order='none')
+    else:
+        cse_replacements = []
+
+    printer = _FloorModC99CodePrinter(settings={'human': False})
+    not_supported = set()
+
+    def print_c(expr):
+        _, expr_not_supported, code = printer.doprint(expr)
+        not_supported.update(expr_not_supported)
+        return code
+
+    lines = [
+        '#include <math.h>',
+        'void simupy_function(const double *_in, double *_out)',
+        '{',
+    ]
+    for sym, rhs in cse_replacements:
+        lines.append('    const double {} = {};'.format(sym, print_c(rhs)))
+    for idx, flat_expr in enumerate(flat_exprs):
+        lines.append('    _out[{}] = {};'.format(idx, print_c(flat_expr)))
+    lines.append('}')
+
+    if not_supported:
+        return lambdify_with_vector_args(args, expr, modules=modules, cse=cse)
+    source = '\n'.join(lines)
+
+    cache_dir = cache_dir or CCODE_CACHE_DIR
+    # the module is only compatible with this python ABI, and -march=native
+    # ties it to this host's CPU, so both are part of the key
+    extension_suffix = importlib.machinery.EXTENSION_SUFFIXES[0]
+    module_name = '_simupy_{}'.format(hashlib.sha256('\n'.join([
+        source, repr(CCODE_COMPILE_ARGS), extension_suffix, platform.node(),
+        platform.machine()
+    ]).encode()).hexdigest()[:32])
+    cached_path = os.path.join(cache_dir, module_name + extension_suffix)
+
+    if not os.path.exists(cached_path):
+        ffi = cffi.FFI()
+        ffi.cdef('void simupy_function(const double *, double *);')
+        ffi.set_source(module_name, source,
+                       extra_compile_args=CCODE_COMPILE_ARGS)
+        # compile in a temporary directory in the cache, then move the module
+        # into place so other processes never load a partially written file
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            build_dir = tempfile.mkdtemp(dir=cache_dir)
+        except OSError:
+            return lambdify_with_vector_args(args, expr, modules=modules,
+                                             cse=cse)
+        try:
+            os.replace(ffi.compile(tmpdir=build_dir), cached_path)
+        except (cffi.VerificationError, OSError):
+            return lambdify_with_vector_args(args, expr, modules=modules,
+                                             cse=cse)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+    module = _load_extension_module(module_name, cached_path)
+
+    ffi, lib = module.ffi, module.lib
+    num_args = len(new_args)
+    n_out = len(flat_exprs)
+    is_tuple = isinstance(expr, sp.Tuple)
+
+    def ccode_function_with_vector_args(*func_args):
+        new_func_args = np.array(process_vector_args(func_args),
+                                 dtype=np.float_)
+        # the compiled function does not check bounds
+        if new_func_args.shape != (num_args,):
+            raise TypeError(
+                "expected {} argument components, got {}".format(
+                    num_args, new_func_args.size))
+        out = np.empty(n_out)
+        lib.simupy_function(ffi.cast('double *', new_func_args.ctypes.data),
+                            ffi.cast('double *', out.ctypes.data))
+        return unflatten_outputs(out, shapes, is_tuple)
+    return ccode_function_with_vector_args
@@ -51,3 +51,401 @@ def test_output_equation_function_kwarg():
         sys.output_equation_function(args[0], args[1:]).squeeze(),
         np.r_[args[1]**2 + args[2]**2, np.arctan2(args[2], args[1])]
     )
+
+
+def test_jacobian_equation_functions():
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants)
+    args = np.random.rand(len(x)+1)
+    npt.assert_allclose(
+        sys.state_jacobian_equation_function(args[0], args[1:]),
+        np.array([
+            [0, 1],
+            [-1-2*constants[mu]*args[1]*args[2],
+             constants[mu]*(1-args[1]**2)]
+        ])
+    )
+
+
+def test_sparse_jacobian_equation_functions():
+    u = dynamicsymbols('u')
+    sys = DynamicalSystem(state=x,
+                          input_=u,
+                          state_equation=r_[x2, -mu*x1 + u*x2],
+                          constants_values=constants)
+    npt.assert_allclose(sys.state_jacobian_sparsity.toarray(),
+                        [[0, 1], [1, 1]])
+    args = np.random.rand(len(x)+2)
+    npt.assert_allclose(
+        sys.state_jacobian_equation_function(args[0], args[1:3], args[3:]),
+        [[0, 1], [-constants[mu], args[3]]]
+    )
+    npt.assert_allclose(
+        sys.input_jacobian_equation_function(args[0], args[1:3], args[3:]),
+        [[0], [args[2]]]
+    )
+
+
+def test_state_and_jacobian_function():
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants)
+    args = np.random.rand(len(x)+1)
+    state_derivative, jacobian = sys.state_and_jacobian_function(
+        args[0], args[1:])
+    npt.assert_allclose(state_derivative,
+                        sys.state_equation_function(args[0], args[1:]))
+    npt.assert_allclose(jacobian,
+                        sys.state_jacobian_equation_function(args[0],
+                                                             args[1:]))
+
+
+def test_jacobian_entries_found_once(monkeypatch):
+    import simupy.systems.symbolic as symbolic
+    nonzero_entries = symbolic._nonzero_entries
+    jacobians = []
+
+    def counting_nonzero_entries(matrix):
+        jacobians.append(matrix)
+        return nonzero_entries(matrix)
+
+    monkeypatch.setattr(symbolic, '_nonzero_entries', counting_nonzero_entries)
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants)
+    sys.state_jacobian_equation_function
+    sys.state_and_jacobian_function
+    sys.state_jacobian_sparsity
+    assert len(jacobians) == 2  # state and input jacobians
+    sys.constants_values = {mu: 1}
+    sys.state_jacobian_sparsity
+    assert len(jacobians) == 4
+
+
+def test_lazy_attribute_build_error():
+    from simupy.utils.symbolic import lambdify_with_vector_args
+
+    def code_generator(args, expr, **kwargs):
+        if isinstance(expr, sp.MatrixBase):
+            raise AttributeError("cannot generate matrices")
+        return lambdify_with_vector_args(args, expr, **kwargs)
+
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants,
+                          code_generator=code_generator)
+    with pytest.raises(RuntimeError) as excinfo:
+        sys.state_jacobian_equation_function
+    assert isinstance(excinfo.value.__cause__, AttributeError)
+
+
+def test_joint_jacobian():
+    from simupy.systems.symbolic import _joint_jacobian
+    from simupy.utils.symbolic import grad
+    u = Array(dynamicsymbols('u1:3'))
+    expr = r_[sp.sin(x1*u[0])*x2, sp.exp(x1 + u[1])*sp.sin(x1*u[0])]
+    state_jacobian, input_jacobian = _joint_jacobian(expr, x, u)
+    assert sp.simplify(state_jacobian - grad(expr, x)) == sp.zeros(2, 2)
+    assert sp.simplify(input_jacobian - grad(expr, u)) == sp.zeros(2, 2)
+
+
+def test_lazy_jacobians():
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants)
+    assert 'state_jacobian_equation' not in sys.__dict__
+    assert 'state_jacobian_equation_function' not in sys.__dict__
+    assert sys.state_jacobian_equation[0, 1] == 1
+    sys.state_jacobian_equation_function(0, [1, 1])
+    assert 'input_jacobian_equation_function' in sys.__dict__
+
+    sys.state_equation = r_[x1, x2]
+    assert 'state_jacobian_equation_function' not in sys.__dict__
+    npt.assert_allclose(sys.state_jacobian_equation_function(0, [1, 1]),
+                        np.eye(2))
+
+
+def test_symengine_llvm_generator():
+    pytest.importorskip('symengine')
+    from simupy.utils.symbolic import lambdify_with_vector_args
+    from simupy.utils.symbolic_backends import symengine_llvm_generator
+    t = dynamicsymbols._t
+    expr = sp.Tuple(state_equation.subs(constants),
+                    sp.Matrix([[x1*x2, sp.cos(t)]]))
+    args = np.random.rand(len(x)+1)
+    for expected, result in zip(
+            lambdify_with_vector_args([t] + list(x), expr)(*args),
+            symengine_llvm_generator([t] + list(x), expr)(*args)):
+        npt.assert_allclose(result, expected)
+
+
+def test_default_generator_fallback():
+    sys = DynamicalSystem(state=x,
+                          state_equation=r_[x2, sp.Mod(x1, 2*sp.pi)])
+    npt.assert_allclose(sys.state_equation_function(0, [7, 1]),
+                        [1, np.mod(7, 2*np.pi)])
+
+
+def test_custom_generator_args():
+    from simupy.utils.symbolic import lambdify_with_vector_args
+
+    generated_args = []
+
+    def code_generator(args, expr, modules=None):
+        generated_args.append(args)
+        return lambdify_with_vector_args(args, expr, modules=modules)
+
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          output_equation=output_equation,
+                          constants_values=constants,
+                          code_generator=code_generator)
+    args = np.random.rand(len(x)+1)
+    npt.assert_allclose(
+        sys.state_equation_function(args[0], args[1:]),
+        np.r_[args[2], -args[1]+constants[mu]*(1-args[1]**2)*args[2]]
+    )
+    assert generated_args[0] == [dynamicsymbols._t, x1, x2]
+
+
+def test_symjit_generator():
+    pytest.importorskip('symjit')
+    from simupy.utils.symbolic_backends import symjit_generator
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants,
+                          code_generator=symjit_generator)
+    args = np.random.rand(len(x)+1)
+    npt.assert_allclose(
+        sys.state_equation_function(args[0], args[1:]),
+        np.r_[args[2], -args[1]+constants[mu]*(1-args[1]**2)*args[2]]
+    )
+
+
+def test_numba_generator():
+    pytest.importorskip('numba')
+    from simupy.utils.symbolic_backends import numba_generator
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          output_equation=output_equation,
+                          constants_values=constants,
+                          code_generator=numba_generator)
+    args = np.random.rand(len(x)+1)
+    npt.assert_allclose(
+        sys.state_equation_function(args[0], args[1:]),
+        np.r_[args[2], -args[1]+constants[mu]*(1-args[1]**2)*args[2]]
+    )
+    npt.assert_allclose(
+        sys.output_equation_function(args[0], args[1:]),
+        np.r_[args[1]**2 + args[2]**2, np.arctan2(args[2], args[1])]
+    )
+    with pytest.raises(TypeError):
+        sys.state_equation_function(*np.random.rand(len(x)+2))
+    with pytest.raises(TypeError):
+        sys.state_equation_function(args[0], args[1:2])
+
+
+def test_numba_generator_fallback():
+    pytest.importorskip('numba')
+    import math
+    from simupy.utils.symbolic_backends import numba_generator
+    t = dynamicsymbols._t
+    # Numba cannot type Max or erf, and Heaviside is not printed
+    for expr, expected in [(sp.Max(x1, x2), 2.), (sp.erf(x1), math.erf(2.)),
+                           (sp.Heaviside(x1 - x2), 1.)]:
+        f = numba_generator([t] + list(x), Array([expr]),
+                            modules=['numpy', 'sympy'])
+        npt.assert_allclose(np.asarray(f(0, 2., 1.), dtype=np.float_),
+                            [expected])
+
+
+def test_ccode_generator(tmpdir):
+    pytest.importorskip('cffi')
+    import importlib.machinery
+    from simupy.utils.symbolic_backends import ccode_generator
+    t = dynamicsymbols._t
+    expr = state_equation.subs(constants)
+    args = np.random.rand(len(x)+1)
+    for _ in range(2):  # the second function loads the cached module
+        f = ccode_generator([t] + list(x), expr, cache_dir=str(tmpdir))
+        npt.assert_allclose(
+            f(*args),
+            np.r_[args[2], -args[1]+constants[mu]*(1-args[1]**2)*args[2]]
+        )
+    with pytest.raises(TypeError):
+        f(*args[:-1])
+    # only the module is left in the cache, named for this python ABI
+    assert len(tmpdir.listdir()) == 1
+    assert tmpdir.listdir()[0].basename.endswith(
+        importlib.machinery.EXTENSION_SUFFIXES[0])
+    # Mod takes the sign of the divisor, unlike C's fmod
+    f = ccode_generator([t] + list(x), Array([sp.Mod(x1, x2)]),
+                        cache_dir=str(tmpdir))
+    npt.assert_allclose(f(0, -1.5, 2.), [0.5])
+    npt.assert_allclose(f(0, 1.5, -2.), [-0.5])
+
+
+def test_prepare_to_integrate_code_generator():
+    from simupy.utils.symbolic import lambdify_with_vector_args
+    generated = []
+
+    def code_generator(args, expr, **kwargs):
+        generated.append(expr)
+        return lambdify_with_vector_args(args, expr, **kwargs)
+
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants)
+    sys.code_generator = code_generator
+    sys.prepare_to_integrate()
+    assert len(generated) == 2  # state and output equations
+
+
+def test_constants_values_assignment():
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants)
+    with pytest.raises(TypeError):
+        sys.constants_values[mu] = 1
+    with pytest.raises(ValueError):
+        sys.constants_values = {'mu': 1}
+    sys.constants_values = {mu: 0.5}
+    assert sys._substitute_constants(mu*x1) == x1/2
+    assert sys.copy()._substitute_constants(mu*x1) == x1/2
+    sys.constants_values = {mu: 1}
+    sys.prepare_to_integrate()
+    args = np.random.rand(len(x)+1)
+    npt.assert_allclose(
+        sys.state_equation_function(args[0], args[1:]).squeeze(),
+        np.r_[args[2], -args[1]+(1-args[1]**2)*args[2]]
+    )
+
+
+def test_code_generator_cache():
+    from sympy.utilities.lambdify import implemented_function
+    from simupy.utils.symbolic import lambdify_with_vector_args
+    generated = []
+
+    def code_generator(args, expr, **kwargs):
+        generated.append(expr)
+        return lambdify_with_vector_args(args, expr, **kwargs)
+
+    systems = [
+        DynamicalSystem(state=x,
+                        state_equation=state_equation,
+                        constants_values=constants,
+                        code_generator=code_generator)
+        for _ in range(2)
+    ]
+    assert systems[0].state_equation_function is \
+        systems[1].state_equation_function
+    assert len(generated) == 2  # state and output equations
+
+    from simupy.systems.symbolic import _compile
+    f = implemented_function('f', lambda value: 2*value)
+    args = [dynamicsymbols._t, x1]
+    functions = [_compile(code_generator, args, f(x1), {}) for _ in range(2)]
+    assert functions[0] is not functions[1]
+    assert len(generated) == 4
+    npt.assert_allclose(functions[1](0, 3), 6)
+
+
+def test_lambdify_cse():
+    from simupy.utils.symbolic import lambdify_with_vector_args
+    t = dynamicsymbols._t
+    expr = sp.Tuple(state_equation.subs(constants),
+                    sp.Matrix([[sp.sin(x1)*x2, sp.sin(x1)+t]]))
+    args = np.random.rand(len(x)+1)
+    for expected, result in zip(
+            lambdify_with_vector_args([t] + list(x), expr, cse=False)(*args),
+            lambdify_with_vector_args([t] + list(x), expr)(*args)):
+        npt.assert_allclose(result, expected)
+
+
+def test_lambdify_array_args():
+    from simupy.utils.symbolic import lambdify_array_args
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          constants_values=constants,
+                          code_generator=lambdify_array_args)
+    args = np.random.rand(len(x)+1)
+    npt.assert_allclose(
+        sys.state_equation_function(args[0], args[1:]).squeeze(),
+        np.r_[args[2], -args[1]+constants[mu]*(1-args[1]**2)*args[2]]
+    )
+    npt.assert_allclose(
+        sys.state_jacobian_equation_function(args[0], args[1:])[0],
+        [0, 1]
+    )
+    with pytest.raises(TypeError):
+        sys.state_equation_function(args[0], args)
+    # column vectors and 0-d times are handled like process_vector_args
+    npt.assert_allclose(
+        sys.state_equation_function(np.array(args[0]),
+                                    args[1:].reshape(-1, 1)),
+        np.r_[args[2], -args[1]+constants[mu]*(1-args[1]**2)*args[2]]
+    )
+
+
+def test_constant_equations_not_generated():
+    from simupy.utils.symbolic import lambdify_with_vector_args
+    generated = []
+
+    def code_generator(args, expr, **kwargs):
+        generated.append(expr)
+        return lambdify_with_vector_args(args, expr, **kwargs)
+
+    sys = DynamicalSystem(state=x,
+                          state_equation=r_[x2, -x1],
+                          output_equation=r_[1, mu],
+                          constants_values=constants,
+                          code_generator=code_generator)
+    npt.assert_allclose(sys.output_equation_function(0, [1, 1]),
+                        [1, constants[mu]])
+    npt.assert_allclose(sys.state_jacobian_equation_function(0, [1, 1]),
+                        [[0, 1], [-1, 0]])
+    assert generated == [r_[x2, -x1]]
+
+
+def test_equilibrium_points_cache():
+    sys = DynamicalSystem(state=x,
+                          state_equation=r_[x2, -x1 - 1],
+                          constants_values=constants)
+    assert sys.equilibrium_points() == [{x1: -1, x2: 0}]
+    assert len(sys._equilibrium_cache) == 1
+    sys.equilibrium_points()[0][x1] = 0
+    assert sys.equilibrium_points() == [{x1: -1, x2: 0}]
+    sys.state_equation = r_[x2, -x1]
+    assert sys.equilibrium_points() == [{x1: 0, x2: 0}]
+
+
+def test_output_equation_function_batched():
+    sys = DynamicalSystem(state=x,
+                          state_equation=state_equation,
+                          output_equation=r_[x1**2 + x2**2, 1],
+                          constants_values=constants)
+    assert 'output_equation_function_batched' not in sys.__dict__
+    t = np.random.rand(5)
+    states = np.random.rand(5, len(x))
+    npt.assert_allclose(
+        sys.output_equation_function_batched(t, states),
+        np.array([
+            sys.output_equation_function(ti, state).squeeze()
+            for ti, state in zip(t, states)
+        ])
+    )
+    npt.assert_allclose(
+        sys.output_jacobian_equation_function(t[0], states[0]),
+        np.array([[2*states[0, 0], 2*states[0, 1]], [0, 0]])
+    )
+
+
+def test_switched_output_single_equation_attributes():
+    from simupy.discontinuities import SwitchedOutput
+    sys = SwitchedOutput(event_variable_equation=x1,
+                         event_bounds_expressions=[0],
+                         output_equations=sp.Array([[-x1], [2*x1]]),
+                         input_=x1)
+    assert not hasattr(sys, 'output_equation_function_batched')
+    assert not hasattr(sys, 'output_jacobian_equation')